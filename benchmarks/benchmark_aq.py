@@ -1,6 +1,8 @@
 """Benchmarks for affine quantized tensor, this includes int8 dynamic quant, int8 weight only quant and int4 weight only quant APIs
 """
 import torch
+import torch._inductor.config
+import torch.utils.benchmark as benchmark
 from torchao.quantization.subclass import (
     Int8WeightOnlyQuantizedLinearWeight,
     Int4WeightOnlyQuantizedLinearWeight,
@@ -13,6 +15,13 @@ from torchao.quantization.quant_api import (
 )
 import copy
 
+# search around the autotuned kernel configs for faster tile sizes
+torch._inductor.config.coordinate_descent_tuning = True
+# fuse the int8 dynamic quant `_int_mm -> cast -> mul` into one kernel
+torch._inductor.config.force_fuse_int_mm_with_mul = True
+# reuse compiled graphs across runs, each api is compiled with max-autotune
+torch._inductor.config.fx_graph_cache = True
+
 class ToyLinearModel(torch.nn.Module):
     def __init__(self, m=64, n=32, k=64):
         super().__init__()
@@ -69,6 +78,15 @@ _ref_change_linear_weights_to_int8_woqtensors = _get_ref_change_linear_weights_t
 _ref_change_linear_weights_to_int4_woqtensors = _get_ref_change_linear_weights_to_woqtensors(Int4WeightOnlyQuantizedLinearWeight)
 
 
+def _median_time_in_microseconds(f, *args):
+    # warm up (which also compiles), then let torch.utils.benchmark.Timer synchronize
+    # cuda and pick the number of runs; the median is robust to a few slow outliers
+    f(*args)
+    f(*args)
+    t = benchmark.Timer(stmt="f(*args)", globals={"f": f, "args": args})
+    return t.blocked_autorange().median * 1e6
+
+
 def _bench_quantized_tensor_subclass_perf(api, ref_api, kwargs=None):
     if kwargs is None:
         kwargs = {}
@@ -83,27 +101,22 @@ def _bench_quantized_tensor_subclass_perf(api, ref_api, kwargs=None):
     # reference
     ref_api(m_ref, **kwargs)
 
-    res = m(*example_inputs)
-    ref = m_ref(*example_inputs)
-
-    assert torch.equal(res, ref)
+    # keep autograd bookkeeping out of both the correctness check and the timed region
+    with torch.no_grad():
+        res = m(*example_inputs)
+        ref = m_ref(*example_inputs)
 
-    # perf comparison
-    from torchao.utils import benchmark_model
-    # warmup
-    WARMUP = 5
-    RUNS = 100
-    input_tensor = example_inputs[0]
-    m = torch.compile(m, mode='max-autotune', fullgraph=True)
+        assert torch.equal(res, ref)
 
-    benchmark_model(m, WARMUP, input_tensor)
-    elapsed_time = benchmark_model(m, RUNS, input_tensor)
+        # perf comparison
+        input_tensor = example_inputs[0]
+        m = torch.compile(m, mode='max-autotune', fullgraph=True)
+        elapsed_time = _median_time_in_microseconds(m, input_tensor)
 
-    m_ref = torch.compile(m_ref, mode='max-autotune', fullgraph=True)
-    benchmark_model(m_ref, WARMUP, input_tensor)
-    ref_elapsed_time = benchmark_model(m_ref, RUNS, input_tensor)
+        m_ref = torch.compile(m_ref, mode='max-autotune', fullgraph=True)
+        ref_elapsed_time = _median_time_in_microseconds(m_ref, input_tensor)
 
-    print(f"elapsed time: {elapsed_time}, ref elapsed time: {ref_elapsed_time}")
+    print(f"elapsed time: {elapsed_time} us, ref elapsed time: {ref_elapsed_time} us")
     assert elapsed_time < 1.05 * ref_elapsed_time
 
 if __name__ == "__main__" and TORCH_VERSION_AFTER_2_4 and torch.cuda.is_available():
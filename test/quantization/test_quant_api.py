@@ -9,10 +9,18 @@
 import unittest
 import torch
 import os
+import functools
+import hashlib
+import tempfile
+from unittest import mock
 from torch.ao.quantization.quantize_pt2e import (
     prepare_pt2e,
     convert_pt2e,
 )
+from torch.ao.quantization.observer import (
+    MinMaxObserver,
+    PerChannelMinMaxObserver,
+)
 from torch.ao.quantization.quantizer.xnnpack_quantizer import (
     XNNPACKQuantizer,
     get_symmetric_quantization_config,
@@ -32,9 +40,13 @@ from torchao.quantization.subclass import (
     LinearActQuantizedTensor,
     Int8WeightOnlyQuantizedLinearWeight,
     Int4WeightOnlyQuantizedLinearWeight,
+    Int8DynamicallyQuantizedLinearWeight,
 )
 from torchao.quantization.quant_api import (
     _replace_with_custom_fn_if_matches_filter,
+    _in_features_greater_than_16,
+    _is_linear,
+    _get_subclass_inserter,
     apply_dynamic_quant,
     apply_weight_only_int8_quant,
     Quantizer,
@@ -44,63 +56,142 @@ from torchao.quantization.quant_api import (
     get_apply_int4wo_quant,
     get_apply_int8wo_quant,
     get_apply_int8dyn_quant,
+    Int8DynActInt4WeightQuantizer,
+)
+from torchao.quantization.GPTQ import (
+    Int8DynActInt4WeightLinear,
+    Int8DynActInt4WeightGPTQQuantizer,
+    Int4WeightOnlyGPTQQuantizer,
+    Int4WeightOnlyQuantizer,
 )
+from torchao.quantization.utils import _lm_eval_available
 from torchao.utils import (
     TORCH_VERSION_AFTER_2_3,
     TORCH_VERSION_AFTER_2_4,
+    unwrap_tensor_subclass,
 )
 from pathlib import Path
 from torchao._models.llama.tokenizer import get_tokenizer
 from torchao._models.llama.model import Transformer, prepare_inputs_for_model
 import copy
 
+if _lm_eval_available:
+    from torchao._models._eval import InputRecorder, TransformerEvalWrapper
+
+
+_DYNAMIC_QUANTIZER = XNNPACKQuantizer().set_global(get_symmetric_quantization_config(is_dynamic=True))
+
+@functools.lru_cache(maxsize=None)
+def _example_input(in_features, dtype=torch.float32, device="cpu"):
+    # export only needs shape, dtype and device, so skip the RNG and reuse the tensor
+    return torch.zeros(1, in_features, dtype=dtype, device=device)
+
+def _export_linear(in_features, out_features, bias, dtype, device):
+    """
+    Exports a stub linear of the given shape, the exported program only depends
+    on the shape and the torch version. If TORCHAO_TEST_EXPORT_CACHE_DIR points at
+    a directory the user owns, the exported program is cached there across test runs
+    """
+    linear = torch.nn.Linear(in_features, out_features, bias=bias, dtype=dtype, device=device)
+    example_inputs = (_example_input(in_features, dtype, device),)
+    cache_dir = os.environ.get("TORCHAO_TEST_EXPORT_CACHE_DIR")
+    if cache_dir is None:
+        return torch.export.export(linear, example_inputs)
+
+    key = f"{in_features}-{out_features}-{bias}-{dtype}-{device}-{torch.__version__}"
+    path = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".pt2")
+    if os.path.exists(path):
+        return torch.export.load(path)
+
+    exported_program = torch.export.export(linear, example_inputs)
+    # write to a temporary file first so concurrent test runs never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.export.save(exported_program, tmp_path)
+    os.replace(tmp_path, path)
+    return exported_program
+
+@functools.lru_cache(maxsize=None)
+def _exported_linear_module(in_features, out_features, bias, dtype, device):
+    """
+    Export only depends on the shape, dtype and device so the exported module is
+    shared by all linears with the same key, prepare_pt2e runs on a copy per linear
+    since a deepcopy of an already prepared graph can't be converted
+    """
+    return _export_linear(in_features, out_features, bias, dtype, device).module()
+
+def _linear_key(linear_mod):
+    return (
+        linear_mod.in_features,
+        linear_mod.out_features,
+        linear_mod.bias is not None,
+        linear_mod.weight.dtype,
+        linear_mod.weight.device,
+    )
+
+def _prepare_like(linear_mod):
+    m = _exported_linear_module(*_linear_key(linear_mod))
+    # bind the real weight and bias into the copy instead of copying the stub's
+    # parameters and then overwriting them
+    memo = {id(param): linear_mod.get_parameter(name) for name, param in m.named_parameters()}
+    m = copy.deepcopy(m, memo)
+    return prepare_pt2e(m, _DYNAMIC_QUANTIZER)
+
+def _collect_modules(model, module_type):
+    return [
+        (fqn, mod)
+        for fqn, mod in model.named_modules(remove_duplicate=False)
+        if isinstance(mod, module_type)
+    ]
+
+def _swap_modules(model, modules, replacement_fn):
+    """
+    Replaces each `(fqn, module)` pair in `modules` with `replacement_fn(module)`,
+    `modules` is collected up front so the model is only walked once, a module
+    registered under several names is replaced once and stays shared
+    """
+    replacements = {}
+    for fqn, mod in modules:
+        if id(mod) not in replacements:
+            replacements[id(mod)] = replacement_fn(mod)
+        if fqn == "":
+            return replacements[id(mod)]
+        parent_fqn, _, name = fqn.rpartition(".")
+        setattr(model.get_submodule(parent_fqn), name, replacements[id(mod)])
+    return model
 
-def dynamic_quant(model, example_inputs):
-    m = torch.export.export(model, example_inputs).module()
-    quantizer = XNNPACKQuantizer().set_global(get_symmetric_quantization_config(is_dynamic=True))
-    m = prepare_pt2e(m, quantizer)
+def dynamic_quant(linear_mod):
+    m = capture_and_prepare(linear_mod)
     m = convert_pt2e(m)
     return m
 
+_WEIGHT_OBSERVER_TYPES = (MinMaxObserver, PerChannelMinMaxObserver)
+
 def _apply_dynamic_quant(model):
     """
     Applies dynamic symmetric per-token activation and per-channel weight
     quantization to all linear layers in the given model using
     module swaps.
     """
-    _replace_with_custom_fn_if_matches_filter(
-        model,
-        lambda linear_mod: dynamic_quant(linear_mod, (torch.randn(1, linear_mod.in_features),)),
-        lambda mod, fqn: isinstance(mod, torch.nn.Linear),
-    )
-    return model
+    return _swap_modules(model, _collect_modules(model, torch.nn.Linear), dynamic_quant)
 
 
-def capture_and_prepare(model, example_inputs):
-    m = torch.export.export(model, example_inputs)
-    quantizer = XNNPACKQuantizer().set_global(get_symmetric_quantization_config(is_dynamic=True))
-    m = prepare_pt2e(m, quantizer)
+def capture_and_prepare(linear_mod):
+    m = _prepare_like(linear_mod)
     # TODO: we can run the weight observer in convert_pt2e so that user don't need to run this
-    m(*example_inputs)
+    # activation observers for dynamic quant don't record anything, so only feed
+    # the weight observers instead of running a full forward
+    for mod in m.modules():
+        if isinstance(mod, _WEIGHT_OBSERVER_TYPES):
+            mod(linear_mod.weight)
     return m
 
 class XNNPackDynamicQuantizer(TwoStepQuantizer):
 
     def prepare(self, model: torch.nn.Module) -> torch.nn.Module:
-        _replace_with_custom_fn_if_matches_filter(
-            model,
-            lambda linear_mod: capture_and_prepare(linear_mod, (torch.randn(1, linear_mod.in_features))),
-            lambda mod, fqn: isinstance(mod, torch.nn.Linear),
-        )
-        return model
+        return _swap_modules(model, _collect_modules(model, torch.nn.Linear), capture_and_prepare)
 
     def convert(self, model: torch.nn.Module) -> torch.nn.Module:
-        _replace_with_custom_fn_if_matches_filter(
-            model,
-            lambda linear_mod: convert_pt2e(linear_mod),
-            lambda mod, fqn: isinstance(mod, torch.fx.GraphModule),
-        )
-        return model
+        return _swap_modules(model, _collect_modules(model, torch.fx.GraphModule), convert_pt2e)
 
 class TorchCompileDynamicQuantizer(Quantizer):
     def quantize(self, model: torch.nn.Module) -> torch.nn.Module:
@@ -127,11 +218,6 @@ def _ref_change_linear_weights_to_int8_dqtensors(model, filter_fn=None, **kwargs
     The deprecated implementation for int8 dynamic quant API, used as a reference for
     numerics and performance
     """
-    from torchao.quantization.quant_api import _in_features_greater_than_16
-    from torchao.quantization.quant_api import _is_linear
-    from torchao.quantization.quant_api import _get_subclass_inserter
-    from torchao.quantization.subclass import Int8DynamicallyQuantizedLinearWeight
-
     if filter_fn is None:
         filter_fn = lambda *args: _is_linear(*args) and _in_features_greater_than_16(
             *args
@@ -147,9 +233,6 @@ def _get_ref_change_linear_weights_to_woqtensors(deprecated_tenosr_subclass):
         The deprecated implementation for weight only quant API, used as a reference for
         numerics and performance
         """
-        from torchao.quantization.quant_api import _is_linear
-        from torchao.quantization.quant_api import _get_subclass_inserter
-
         filter_fn = kwargs.pop("filter_fn", _is_linear)
 
         _replace_with_custom_fn_if_matches_filter(
@@ -163,7 +246,44 @@ def _get_ref_change_linear_weights_to_woqtensors(deprecated_tenosr_subclass):
 _ref_change_linear_weights_to_int8_woqtensors = _get_ref_change_linear_weights_to_woqtensors(Int8WeightOnlyQuantizedLinearWeight)
 _ref_change_linear_weights_to_int4_woqtensors = _get_ref_change_linear_weights_to_woqtensors(Int4WeightOnlyQuantizedLinearWeight)
 
+def _load_gpt_fast_model(checkpoint_path):
+    # build on meta so the checkpoint's mmap-ed tensors are assigned without
+    # first allocating a full-precision copy of the randomly initialized weights
+    with torch.device("meta"):
+        model = Transformer.from_name(checkpoint_path.parent.name)
+    checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
+    model.load_state_dict(checkpoint, assign=True)
+    return model
+
 class TestQuantFlow(unittest.TestCase):
+    def test_dynamic_quant_export_cache(self):
+        m = ToyLinearModel().eval()
+        example_inputs = m.example_inputs()
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                mock.patch.dict(os.environ, {"TORCHAO_TEST_EXPORT_CACHE_DIR": cache_dir}):
+            # cache miss: exports and writes one program per linear shape
+            _exported_linear_module.cache_clear()
+            miss = _apply_dynamic_quant(copy.deepcopy(m))
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # cache hit: loads from disk without exporting again
+            _exported_linear_module.cache_clear()
+            with mock.patch("torch.export.export", side_effect=AssertionError("should load from cache")):
+                hit = _apply_dynamic_quant(copy.deepcopy(m))
+        _exported_linear_module.cache_clear()
+
+        self.assertTrue(torch.equal(miss(*example_inputs), hit(*example_inputs)))
+
+    def test_dynamic_quant_root_and_shared_linear(self):
+        m = _apply_dynamic_quant(torch.nn.Linear(64, 32, bias=False))
+        self.assertIsInstance(m, torch.fx.GraphModule)
+
+        m = ToyLinearModel().eval()
+        m.linear3 = m.linear1
+        m = _apply_dynamic_quant(m)
+        self.assertIsInstance(m.linear1, torch.fx.GraphModule)
+        self.assertIs(m.linear1, m.linear3)
+
     def test_dynamic_quant_gpu_singleline(self):
         m = ToyLinearModel().eval()
         example_inputs = m.example_inputs()
@@ -176,6 +296,32 @@ class TestQuantFlow(unittest.TestCase):
         # compiled = m(*example_inputs)
         # torch.testing.assert_close(quantized, compiled, atol=0, rtol=0)
 
+    def test_dynamic_quant_xnnpack_quantizer_prepare_convert(self):
+        quantizer = XNNPackDynamicQuantizer()
+        m = ToyLinearModel().eval()
+        m_ref = copy.deepcopy(m)
+        example_inputs = m.example_inputs()
+        m = quantizer.prepare(m)
+        for linear in [m.linear1, m.linear2]:
+            observers = [mod for mod in linear.modules() if isinstance(mod, _WEIGHT_OBSERVER_TYPES)]
+            self.assertEqual(len(observers), 1)
+            for observer in observers:
+                self.assertTrue(torch.isfinite(observer.min_val).all())
+                self.assertTrue(torch.isfinite(observer.max_val).all())
+        m = quantizer.convert(m)
+
+        # reference: export each real linear and calibrate with a forward, without
+        # any of the caching or observer shortcuts above
+        for name in ["linear1", "linear2"]:
+            linear = getattr(m_ref, name)
+            ref_inputs = (torch.randn(1, linear.in_features),)
+            ref_quantizer = XNNPACKQuantizer().set_global(get_symmetric_quantization_config(is_dynamic=True))
+            ref = prepare_pt2e(torch.export.export(linear, ref_inputs).module(), ref_quantizer)
+            ref(*ref_inputs)
+            setattr(m_ref, name, convert_pt2e(ref))
+
+        torch.testing.assert_close(m(*example_inputs), m_ref(*example_inputs), atol=0, rtol=0)
+
     @unittest.skip("skipping for now due to torch.compile error")
     def test_dynamic_quant_gpu_unified_api_unified_impl(self):
         quantizer = XNNPackDynamicQuantizer()
@@ -224,33 +370,29 @@ class TestQuantFlow(unittest.TestCase):
 
     @unittest.skipIf(not TORCH_VERSION_AFTER_2_3, "skipping when torch verion is 2.3 or lower")
     def test_8da4w_quantizer(self):
-        from torchao.quantization.quant_api import Int8DynActInt4WeightQuantizer
-        from torchao.quantization.GPTQ import Int8DynActInt4WeightLinear
-
-        quantizer = Int8DynActInt4WeightQuantizer(groupsize=32)
-        m = ToyLinearModel().eval()
-        example_inputs = m.example_inputs()
-        m = quantizer.quantize(m)
-        assert isinstance(m.linear1, Int8DynActInt4WeightLinear)
-        assert isinstance(m.linear2, Int8DynActInt4WeightLinear)
-        m(*example_inputs)
+        for precision in [torch.bfloat16, torch.float32]:
+            with self.subTest(precision=precision):
+                quantizer = Int8DynActInt4WeightQuantizer(groupsize=32, precision=precision)
+                m = ToyLinearModel().eval().to(precision)
+                example_inputs = m.example_inputs(dtype=precision)
+                m = quantizer.quantize(m)
+                assert isinstance(m.linear1, Int8DynActInt4WeightLinear)
+                assert isinstance(m.linear2, Int8DynActInt4WeightLinear)
+                m(*example_inputs)
 
     # TODO: save model weights as artifacts and re-enable in CI
     # For now, to run this test, you will need to download the weights from HF
     # and run this script to convert them:
     # https://github.com/pytorch-labs/gpt-fast/blob/6253c6bb054e658d67566150f87329b87815ae63/scripts/convert_hf_checkpoint.py
     @unittest.skip("skipping until we get checkpoints for gpt-fast")
+    @unittest.skipIf(not _lm_eval_available, "lm_eval is not installed")
     def test_8da4w_gptq_quantizer(self):
-        from torchao.quantization.GPTQ import Int8DynActInt4WeightGPTQQuantizer
-        from torchao._models._eval import InputRecorder, TransformerEvalWrapper
         torchao._models.llama.model.use_index_put_for_kv_cache = True
         # should be similar to TorchCompileDynamicQuantizer
         precision = torch.bfloat16
         device = "cpu"
         checkpoint_path = Path("../gpt-fast/checkpoints/meta-llama/Llama-2-7b-chat-hf/model.pth")
-        model = Transformer.from_name(checkpoint_path.parent.name)
-        checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
-        model.load_state_dict(checkpoint, assign=True)
+        model = _load_gpt_fast_model(checkpoint_path)
         model = model.to(dtype=precision, device=device)
         model.eval()
         tokenizer_path = checkpoint_path.parent / "tokenizer.model"
@@ -304,16 +446,12 @@ class TestQuantFlow(unittest.TestCase):
 
     @unittest.skip("skipping until we get checkpoints for gpt-fast")
     @unittest.skipIf(not TORCH_VERSION_AFTER_2_4, "skipping when torch verion is 2.4 or lower")
+    @unittest.skipIf(not _lm_eval_available, "lm_eval is not installed")
     def test_8da4w_quantizer_eval(self):
-        from torchao.quantization.quant_api import Int8DynActInt4WeightQuantizer
-        from torchao._models._eval import TransformerEvalWrapper
-
         precision = torch.bfloat16
         device = "cpu"
         checkpoint_path = Path("../gpt-fast/checkpoints/meta-llama/Llama-2-7b-chat-hf/model.pth")
-        model = Transformer.from_name(checkpoint_path.parent.name)
-        checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
-        model.load_state_dict(checkpoint, assign=True)
+        model = _load_gpt_fast_model(checkpoint_path)
         model = model.to(dtype=precision, device=device)
         model.eval()
         tokenizer_path = checkpoint_path.parent / "tokenizer.model"
@@ -340,16 +478,13 @@ class TestQuantFlow(unittest.TestCase):
         )
 
     @unittest.skip("skipping until we get checkpoints for gpt-fast")
+    @unittest.skipIf(not _lm_eval_available, "lm_eval is not installed")
     def test_gptq_quantizer_int4wo(self):
-        from torchao.quantization.GPTQ import Int4WeightOnlyGPTQQuantizer
-        from torchao._models._eval import InputRecorder, TransformerEvalWrapper
         torchao._models.llama.model.use_index_put_for_kv_cache = True
         precision = torch.bfloat16
         device = "cuda"
         checkpoint_path = Path("../gpt-fast/checkpoints/meta-llama/Llama-2-7b-chat-hf/model.pth")
-        model = Transformer.from_name(checkpoint_path.parent.name)
-        checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
-        model.load_state_dict(checkpoint, assign=True)
+        model = _load_gpt_fast_model(checkpoint_path)
         model = model.to(dtype=precision, device="cpu")
         model.eval()
         tokenizer_path = checkpoint_path.parent / "tokenizer.model"
@@ -402,15 +537,12 @@ class TestQuantFlow(unittest.TestCase):
         )
 
     @unittest.skip("skipping until we get checkpoints for gpt-fast")
+    @unittest.skipIf(not _lm_eval_available, "lm_eval is not installed")
     def test_quantizer_int4wo(self):
-        from torchao.quantization.GPTQ import Int4WeightOnlyQuantizer
-        from torchao._models._eval import TransformerEvalWrapper
         precision = torch.bfloat16
         device = "cuda"
         checkpoint_path = Path("../gpt-fast/checkpoints/meta-llama/Llama-2-7b-chat-hf/model.pth")
-        model = Transformer.from_name(checkpoint_path.parent.name)
-        checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
-        model.load_state_dict(checkpoint, assign=True)
+        model = _load_gpt_fast_model(checkpoint_path)
         model = model.to(dtype=precision, device=device)
         model.eval()
         tokenizer_path = checkpoint_path.parent / "tokenizer.model"
@@ -439,14 +571,12 @@ class TestQuantFlow(unittest.TestCase):
         )
 
     @unittest.skip("skipping until we get checkpoints for gpt-fast")
+    @unittest.skipIf(not _lm_eval_available, "lm_eval is not installed")
     def test_eval_wrapper(self):
-        from torchao._models._eval import TransformerEvalWrapper
         precision = torch.bfloat16
         device = "cuda"
         checkpoint_path = Path("../gpt-fast/checkpoints/meta-llama/Llama-2-7b-chat-hf/model.pth")
-        model = Transformer.from_name(checkpoint_path.parent.name)
-        checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
-        model.load_state_dict(checkpoint, assign=True)
+        model = _load_gpt_fast_model(checkpoint_path)
         model = model.to(dtype=precision, device=device)
         model.eval()
         tokenizer_path = checkpoint_path.parent / "tokenizer.model"
@@ -471,14 +601,12 @@ class TestQuantFlow(unittest.TestCase):
 
     # EVAL IS CURRENTLY BROKEN FOR LLAMA 3, VERY LOW ACCURACY
     @unittest.skip("skipping until we get checkpoints for gpt-fast")
+    @unittest.skipIf(not _lm_eval_available, "lm_eval is not installed")
     def test_eval_wrapper_llama3(self):
-        from torchao._models._eval import TransformerEvalWrapper
         precision = torch.bfloat16
         device = "cuda"
         checkpoint_path = Path(".../gpt-fast/checkpoints/meta-llama/Meta-Llama-3-8B/model.pth")
-        model = Transformer.from_name(checkpoint_path.parent.name)
-        checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
-        model.load_state_dict(checkpoint, assign=True)
+        model = _load_gpt_fast_model(checkpoint_path)
         model = model.to(dtype=precision, device=device)
         model.eval()
         tokenizer_path = checkpoint_path.parent / "tokenizer.model"
@@ -516,9 +644,6 @@ class TestQuantFlow(unittest.TestCase):
         assert isinstance(m.linear2.weight.original_weight_tensor, AffineQuantizedTensor)
 
         # reference
-        from torchao.quantization.quant_api import Int8DynActInt4WeightQuantizer
-        from torchao.quantization.GPTQ import Int8DynActInt4WeightLinear
-
         quantizer = Int8DynActInt4WeightQuantizer(groupsize=groupsize)
         m_copy = quantizer.quantize(m_copy)
         assert isinstance(m_copy.linear1, Int8DynActInt4WeightLinear)
@@ -596,7 +721,6 @@ class TestQuantFlow(unittest.TestCase):
         self.assertTrue(torch.equal(res, ref))
 
         # workaround for export path
-        from torchao.utils import unwrap_tensor_subclass
         m_unwrapped = unwrap_tensor_subclass(m)
 
         m = torch.export.export(m_unwrapped, example_inputs).module()